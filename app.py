@@ -3,33 +3,51 @@
 from dotenv import load_dotenv
 load_dotenv()
 
+# Searches run concurrently in worker threads; keep OpenMP/BLAS pools from
+# oversubscribing cores. Must be set before numpy/faiss are first imported.
+import os
+os.environ.setdefault("OMP_NUM_THREADS", os.getenv("FAISS_NUM_THREADS", "1"))
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+
 # THEN: Import other modules
-from flask import Flask, request, jsonify, render_template
+from quart import Quart, Response, request, jsonify, render_template
 import uuid
-import asyncio
+import json
+import logging
+
+# Log messages from our own modules (LOG_LEVEL=DEBUG shows retrieved documents)
+logging.basicConfig(format="%(message)s")
+logging.getLogger("modules").setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
 
-app = Flask(__name__, static_folder="static", template_folder="templates")
+# Quart is Flask's ASGI counterpart: handlers run on one long-lived event loop
+app = Quart(__name__, static_folder="static", template_folder="templates")
 
 # NOW: Import your custom modules
-from modules.chat_engine import get_chat_response
+from modules.chat_engine import get_chat_response, stream_chat_response
+from modules.chat_history import register_session, close_chat_history
+from modules.agent import retriever
 
-# In-memory session store (optional)
-user_sessions = {}
+# Release pooled HTTP and Redis connections on shutdown
+@app.after_serving
+async def close_clients():
+    await retriever.aclose()
+    await close_chat_history()
 
 @app.route('/')
-def home():
-    return render_template("index.html")
+async def home():
+    return await render_template("index.html")
 
 @app.route('/start', methods=['POST'])
-def start_session():
-    data = request.get_json()
+async def start_session():
+    data = await request.get_json()
     user_id = data.get("user_id")
 
     if not user_id:
         user_id = str(uuid.uuid4())[:8]
 
     session_id = f"{user_id}_{uuid.uuid4().hex[:8]}"
-    user_sessions[session_id] = {"user_id": user_id}
+    await register_session(session_id, user_id)
 
     return jsonify({
         "message": "Session started.",
@@ -38,8 +56,8 @@ def start_session():
     })
 
 @app.route('/chat', methods=['POST'])
-def chat():
-    data = request.get_json()
+async def chat():
+    data = await request.get_json()
     message = data.get("message", "").strip()
     session_id = data.get("session_id")
     user_id = data.get("user_id")
@@ -48,11 +66,7 @@ def chat():
         return jsonify({"error": "Missing message, session_id, or user_id"}), 400
 
     try:
-        # Run async function in sync context
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        response = loop.run_until_complete(get_chat_response(message, session_id, user_id))
-        loop.close()
+        response = await get_chat_response(message, session_id, user_id)
         
         return jsonify({
             "response": response,
@@ -65,5 +79,32 @@ def chat():
             "error": True
         }), 500
 
+@app.route('/chat/stream', methods=['POST'])
+async def chat_stream():
+    """Same as /chat, but streams the answer as Server-Sent Events"""
+    data = await request.get_json()
+    message = data.get("message", "").strip()
+    session_id = data.get("session_id")
+    user_id = data.get("user_id")
+
+    if not message or not session_id or not user_id:
+        return jsonify({"error": "Missing message, session_id, or user_id"}), 400
+
+    async def events():
+        try:
+            async for piece in stream_chat_response(message, session_id, user_id):
+                yield f"data: {json.dumps({'token': piece}, ensure_ascii=False)}\n\n"
+            yield f"event: done\ndata: {json.dumps({'session_id': session_id})}\n\n"
+        except Exception as e:
+            print(f"Error in chat stream endpoint: {e}")
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+
+    response = Response(events(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # don't let proxies buffer the stream
+    response.timeout = None  # answers can take longer than the default response timeout
+    return response
+
 if __name__ == '__main__':
-    app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
+    # Local development only; in production run: hypercorn app:app --bind 0.0.0.0:5000
+    app.run(host="0.0.0.0", port=5000)
@@ -1,11 +1,14 @@
 # agent.py - Domestic Animals Help Provider Bot
 
 import os
-from typing import TypedDict, List, Dict, Any
+import re
+from functools import lru_cache
+from typing import TypedDict, List, Dict, Any, Optional, AsyncIterator
 from langgraph.graph import StateGraph, END
 from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_openai import AzureChatOpenAI
 from modules.retriever import VectorRetriever
+from modules.semantic_cache import SemanticCache
 
 # Define the state
 class AgentState(TypedDict):
@@ -16,59 +19,104 @@ class AgentState(TypedDict):
     final_answer: str
     session_id: str
     user_id: str
+    query_embedding: Any
+
+# Initialize retriever (older index builds only have Parquet or pickled metadata)
+for METADATA_PATH in ("vector_store/kb_metadata.arrow", "vector_store/kb_metadata.parquet", "vector_store/kb_metadata.pkl"):
+    if os.path.exists(METADATA_PATH):
+        break
 
-# Initialize retriever
 retriever = VectorRetriever(
     index_path="vector_store/kb_index.faiss",
-    metadata_path="vector_store/kb_metadata.pkl"
+    metadata_path=METADATA_PATH
 )
 
-# Create a function to get LLM instance
-def get_llm():
+# Answers for recently seen, semantically equivalent knowledge-base questions
+semantic_cache = SemanticCache()
+
+# Static prompt prefixes. Keep these byte-identical across calls (no timestamps or
+# per-request data) so the provider's automatic prefix caching can reuse them;
+# everything that varies per request goes in the trailing HumanMessage.
+STANDARD_GREETING = "Hello! I'm your Domestic Animals Help Provider. I can assist with livestock care, animal health, farming practices, and veterinary advice for cattle, goats, chickens, and other farm animals. How can I help you today?"
+
+REFLECT_SYSTEM_PROMPT = """You are a veterinary expert evaluating information about domestic animals and livestock.
+
+You will be given a user's question and information retrieved from a livestock knowledge base.
+
+Analyze the following as a veterinary expert:
+1. How relevant and accurate is the retrieved information for answering the user's question?
+2. Are there any gaps in the information about animal care, treatment, or management?
+3. Is the information sufficient to provide a safe and helpful answer?
+4. What additional veterinary advice or warnings should be considered?
+5. Is the information specific enough to the animal type mentioned?
+
+Provide a concise veterinary evaluation that will help generate a responsible answer."""
+
+ANSWER_SYSTEM_PROMPT = f"""You are a Domestic Animals Help Provider Bot specializing in livestock and farm animals.
+You provide practical, safe advice for farmers and livestock owners based on veterinary knowledge.
+Always prioritize animal welfare and recommend professional veterinary care when needed.
+
+IMPORTANT INSTRUCTIONS:
+1. If the user greets you (e.g., 'hi', 'hello'), respond with the standard greeting
+2. Use the retrieved livestock knowledge base as your PRIMARY source
+3. First silently evaluate the retrieved information as a veterinary expert: its relevance to the question and animal type, gaps in care/treatment/management details, and safety concerns. If a veterinary expert's evaluation is provided, use it. Do not include this evaluation in your reply; output only the final answer
+4. If information is insufficient, recommend consulting a local veterinarian
+5. Format answers with clear, practical steps for farmers/livestock owners
+6. Include important safety warnings when discussing treatments or medications
+7. Reference source information (book name, page) when possible
+8. Be helpful, practical, and focused on Bangladeshi/Bengali livestock context
+
+STANDARD GREETING:
+"{STANDARD_GREETING}"
+
+The user message contains the retrieved livestock knowledge base, the conversation history and the user's question, optionally preceded by a veterinary expert's evaluation. Provide your helpful, practical answer for livestock care."""
+
+# The answer prompt asks the model to critique the context silently, so by default
+# there is no separate reflection call. Setting a (cheaper) deployment here brings
+# back the reflect step in front of generate_answer.
+REFLECTION_DEPLOYMENT = os.getenv("AZURE_OPENAI_REFLECTION_DEPLOYMENT")
+
+# Marks the answer LLM's stream events so stream_agent can tell them apart
+ANSWER_STREAM_TAG = "final_answer"
+
+# One shared LLM client per deployment, so HTTP connection pools are reused across calls
+@lru_cache(maxsize=None)
+def get_llm(deployment: Optional[str] = None):
     """Lazy initialization of LLM"""
     return AzureChatOpenAI(
-        azure_deployment=os.getenv("AZURE_OPENAI_DEPLOYMENT", "gpt-4.1-mini"),
+        azure_deployment=deployment or os.getenv("AZURE_OPENAI_DEPLOYMENT", "gpt-4.1-mini"),
         azure_endpoint=os.getenv("AZURE_OPENAI_URL"),
         api_key=os.getenv("AZURE_OPENAI_KEY"),
-        api_version="2023-05-15",
+        # 2024-10-21 reports cached prompt tokens in the usage block
+        api_version="2024-10-21",
         temperature=0.1
     )
 
-def retrieve_tool(state: AgentState) -> AgentState:
+def log_prompt_cache(stage: str, response):
+    """Log how many prompt tokens were served from the provider's prefix cache"""
+    usage = response.response_metadata.get("token_usage") or {}
+    cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+    print(f"[Agent] {stage} prompt tokens: {usage.get('prompt_tokens')} (cached: {cached})")
+
+async def retrieve_tool(state: AgentState) -> AgentState:
     """Tool: Retrieve relevant documents from knowledge base"""
     print(f"[Agent] Retrieving livestock information for: {state['user_query']}")
-    context = retriever.as_tool(state['user_query'])
+    context = await retriever.as_tool_async(state['user_query'], state.get('query_embedding'))
     return {**state, "retrieved_context": context}
 
-def reflect_critic(state: AgentState) -> AgentState:
+async def reflect_critic(state: AgentState) -> AgentState:
     """Critic: Reflect on the retrieved information and query"""
     print("[Agent] Critic evaluating livestock information quality...")
     
-    reflection_prompt = f"""
-    You are a veterinary expert evaluating information about domestic animals and livestock.
-    
-    User's Question: {state['user_query']}
-    
-    Retrieved Livestock Knowledge Base Information:
-    {state['retrieved_context']}
-    
-    Analyze the following as a veterinary expert:
-    1. How relevant and accurate is the retrieved information for answering the user's question?
-    2. Are there any gaps in the information about animal care, treatment, or management?
-    3. Is the information sufficient to provide a safe and helpful answer?
-    4. What additional veterinary advice or warnings should be considered?
-    5. Is the information specific enough to the animal type mentioned?
-    
-    Provide a concise veterinary evaluation that will help generate a responsible answer.
-    """
-    
-    llm = get_llm()  # Get LLM instance here
+    llm = get_llm(REFLECTION_DEPLOYMENT)  # Get LLM instance here
     messages = [
-        SystemMessage(content="You are a veterinary expert evaluating livestock and domestic animal care information."),
-        HumanMessage(content=reflection_prompt)
+        SystemMessage(content=REFLECT_SYSTEM_PROMPT),
+        HumanMessage(content=f"User's Question: {state['user_query']}\n\n"
+                             f"Retrieved Livestock Knowledge Base Information:\n{state['retrieved_context']}")
     ]
     
-    response = llm.invoke(messages)
+    response = await llm.ainvoke(messages)
+    log_prompt_cache("Reflection", response)
     reflection = response.content
     
     # Add reflection to messages
@@ -79,7 +127,7 @@ def reflect_critic(state: AgentState) -> AgentState:
     
     return {**state, "reflection": reflection}
 
-def generate_answer(state: AgentState) -> AgentState:
+async def generate_answer(state: AgentState) -> AgentState:
     """Generate final answer based on query, context, and reflection"""
     print("[Agent] Generating livestock care answer...")
     
@@ -92,47 +140,28 @@ def generate_answer(state: AgentState) -> AgentState:
     
     history_text = "\n".join(history_messages[-6:])  # Last 6 messages
     
-    answer_prompt = f"""
-    You are a Domestic Animals Help Provider Bot specializing in livestock and farm animals.
-    
-    IMPORTANT INSTRUCTIONS:
-    1. If the user greets you (e.g., 'hi', 'hello'), respond with the standard greeting
-    2. Use the retrieved livestock knowledge base as your PRIMARY source
-    3. Consider the veterinary expert's evaluation for safety and completeness
-    4. If information is insufficient, recommend consulting a local veterinarian
-    5. Format answers with clear, practical steps for farmers/livestock owners
-    6. Include important safety warnings when discussing treatments or medications
-    7. Reference source information (book name, page) when possible
-    8. Be helpful, practical, and focused on Bangladeshi/Bengali livestock context
-    
-    STANDARD GREETING:
-    "Hello! I'm your Domestic Animals Help Provider. I can assist with livestock care, animal health, farming practices, and veterinary advice for cattle, goats, chickens, and other farm animals. How can I help you today?"
-    
-    VETERINARY EXPERT'S EVALUATION:
-    {state['reflection']}
-    
-    RETRIEVED LIVESTOCK KNOWLEDGE BASE:
-    {state['retrieved_context']}
-    
-    CONVERSATION HISTORY:
-    {history_text}
-    
-    USER'S QUESTION ABOUT ANIMALS:
-    {state['user_query']}
-    
-    Provide your helpful, practical answer for livestock care:
-    """
+    evaluation = f"VETERINARY EXPERT'S EVALUATION:\n{state['reflection']}\n\n" if state['reflection'] else ""
+    answer_prompt = f"""{evaluation}RETRIEVED LIVESTOCK KNOWLEDGE BASE:
+{state['retrieved_context']}
+
+CONVERSATION HISTORY:
+{history_text}
+
+USER'S QUESTION ABOUT ANIMALS:
+{state['user_query']}"""
     
     llm = get_llm()  # Get LLM instance here
     messages = [
-        SystemMessage(content="""You are a helpful Domestic Animals Help Provider specializing in livestock care. 
-        You provide practical, safe advice for farmers and livestock owners based on veterinary knowledge.
-        Always prioritize animal welfare and recommend professional veterinary care when needed."""),
+        SystemMessage(content=ANSWER_SYSTEM_PROMPT),
         HumanMessage(content=answer_prompt)
     ]
     
-    response = llm.invoke(messages)
-    final_answer = response.content
+    # Stream the completion; stream_agent forwards the tagged chunks to the client
+    # as they arrive (streamed responses carry no token usage to log)
+    chunks = []
+    async for chunk in llm.astream(messages, config={"tags": [ANSWER_STREAM_TAG]}):
+        chunks.append(chunk.content)
+    final_answer = "".join(chunks)
     
     # Add final answer to messages
     state['messages'].append({
@@ -142,9 +171,49 @@ def generate_answer(state: AgentState) -> AgentState:
     
     return {**state, "final_answer": final_answer}
 
+# Small-talk phrases by kind, matched as whole words. Spelling variants and
+# common typos are covered so they don't fall through to the RAG pipeline.
+_SMALL_TALK_PHRASES = [
+    ("bye", r"good ?bye|bye+(?: bye)?|see (?:you|ya|u)(?: later| soon)?|cya|take care|later"
+            r"|allah hafez|আল্লাহ হাফেজ|বিদায়"),
+    ("thanks", r"thank ?(?:you|u|yu)(?: so much| very much| a lot)?|many thanks|thanks a lot|than[kx]s?"
+               r"|thx|thnx|thnks|tnx|tq|ty|much appreciated|appreciate it|ধন্যবাদ|অনেক ধন্যবাদ|শুকরিয়া"),
+    ("greeting", r"hi+|h+e+l+o+|hey+|hiya|howdy|greetings|good (?:morning|afternoon|evening|day)"
+                 r"|(?:as+)?sala+m+(?: ?[ou]? ?alaikum| ?alaykum)?|assalamualaikum|হ্যালো|সালাম|আসসালামু আলাইকুম|নমস্কার"
+                 r"|how are (?:you|u)|how r u|what'?s up|sup"),
+    # No affirmatives ("yes", "sure"): they usually accept an offer made in the previous answer
+    ("ack", r"ok+|okay|okey|k|alright|all right|got it|fine|cool|great|nice|understood|noted|ঠিক আছে|আচ্ছা"),
+    # Words that don't change the meaning of small talk ("hi there", "thanks bot")
+    ("filler", r"there|bot|khamarbot|friend|dear|sir|madam|bhai|vai|apu|everyone|all|again|so|very|much|and"),
+]
+_SMALL_TALK_RE = [(kind, re.compile(rf"(?<!\S)(?:{phrases})(?!\S)")) for kind, phrases in _SMALL_TALK_PHRASES]
+_NON_WORD_RE = re.compile(r"[^\w\s\u0980-\u09FF']+")
+_SPACES_RE = re.compile(r"\s+")
+# Longer messages are real questions even if they contain pleasantries
+_SMALL_TALK_MAX_LENGTH = 60
+
+def classify_small_talk(query: str) -> Optional[str]:
+    """Return 'bye', 'thanks', 'greeting' or 'ack' if the whole message is small talk, else None"""
+    text = _SPACES_RE.sub(" ", _NON_WORD_RE.sub(" ", query.lower())).strip()
+    if not text or len(text) > _SMALL_TALK_MAX_LENGTH:
+        return None
+
+    kinds = set()
+    for kind, pattern in _SMALL_TALK_RE:
+        text, count = pattern.subn(" ", text)
+        if count and kind != "filler":
+            kinds.add(kind)
+
+    # Anything left over means the message carries an actual request
+    if text.strip() or not kinds:
+        return None
+    for kind in ("bye", "thanks", "greeting", "ack"):
+        if kind in kinds:
+            return kind
+
 def generate_greeting(state: AgentState) -> AgentState:
     """Generate greeting response without retrieval"""
-    greeting = "Hello! I'm your Domestic Animals Help Provider. I can assist with livestock care, animal health, farming practices, and veterinary advice for cattle, goats, chickens, and other farm animals. How can I help you today?"
+    greeting = STANDARD_GREETING
     
     state['messages'].append({
         "role": "animal_care_assistant",
@@ -155,11 +224,11 @@ def generate_greeting(state: AgentState) -> AgentState:
 
 def generate_simple_response(state: AgentState) -> AgentState:
     """Generate response for simple queries without retrieval"""
-    user_query = state['user_query'].lower().strip()
+    kind = classify_small_talk(state['user_query'])
     
-    if user_query.startswith(('thanks', 'thank you')):
+    if kind == "thanks":
         response = "You're welcome! I'm happy to help with your livestock questions. Is there anything else about animal care I can assist you with?"
-    elif user_query.startswith(('bye', 'goodbye')):
+    elif kind == "bye":
         response = "Goodbye! Wishing you and your animals good health. Feel free to reach out if you have more livestock questions."
     else:
         response = "Got it. Please let me know how I can help with your livestock or animal care questions."
@@ -173,16 +242,14 @@ def generate_simple_response(state: AgentState) -> AgentState:
 
 def should_use_tools(state: AgentState) -> str:
     """Router: Decide whether to use retrieval tools or not"""
-    user_query = state['user_query'].lower().strip()
+    kind = classify_small_talk(state['user_query'])
     
     # Greetings don't need retrieval
-    greetings = ['hi', 'hello', 'hey', 'greetings', 'good morning', 'good afternoon', 'assalamualaikum']
-    if any(user_query.startswith(greet) for greet in greetings):
+    if kind == "greeting":
         return "generate_greeting"
     
-    # Simple queries don't need retrieval
-    simple_queries = ['thanks', 'thank you', 'bye', 'goodbye', 'ok', 'okay', 'alright']
-    if any(user_query.startswith(sq) for sq in simple_queries):
+    # Simple queries (thanks, bye, ok) don't need retrieval
+    if kind is not None:
         return "generate_simple_response"
     
     # For animal/livestock related queries, use the full RAG pipeline
@@ -197,7 +264,8 @@ def create_agent_workflow():
     # Add nodes
     workflow.add_node("router", lambda state: state)  # Router node
     workflow.add_node("retrieve", retrieve_tool)
-    workflow.add_node("reflect", reflect_critic)
+    if REFLECTION_DEPLOYMENT:
+        workflow.add_node("reflect", reflect_critic)
     workflow.add_node("generate_answer", generate_answer)
     workflow.add_node("generate_greeting", generate_greeting)
     workflow.add_node("generate_simple_response", generate_simple_response)
@@ -218,8 +286,11 @@ def create_agent_workflow():
     )
     
     # Add edges for RAG pipeline
-    workflow.add_edge("retrieve", "reflect")
-    workflow.add_edge("reflect", "generate_answer")
+    if REFLECTION_DEPLOYMENT:
+        workflow.add_edge("retrieve", "reflect")
+        workflow.add_edge("reflect", "generate_answer")
+    else:
+        workflow.add_edge("retrieve", "generate_answer")
     
     # Add edges to end
     workflow.add_edge("generate_answer", END)
@@ -231,8 +302,8 @@ def create_agent_workflow():
 # Create the compiled agent
 agent = create_agent_workflow()
 
-async def run_agent(user_query: str, session_id: str, user_id: str, history: List[Dict] = None) -> str:
-    """Run the agentic RAG pipeline for livestock assistance"""
+def build_initial_state(user_query: str, session_id: str, user_id: str, history: List[Dict] = None) -> AgentState:
+    """Prepare the graph input from the query and recent chat history"""
     
     # Prepare initial messages from history
     messages = []
@@ -249,19 +320,93 @@ async def run_agent(user_query: str, session_id: str, user_id: str, history: Lis
         "content": user_query
     })
     
-    # Prepare initial state
-    initial_state = AgentState(
+    return AgentState(
         messages=messages,
         user_query=user_query,
         retrieved_context="",
         reflection="",
         final_answer="",
         session_id=session_id,
-        user_id=user_id
+        user_id=user_id,
+        query_embedding=None
     )
+
+def is_standalone(state: AgentState) -> bool:
+    """True if the question has no conversation history. Answers to follow-ups depend on
+    that session's earlier turns, so only standalone questions are shared via the cache"""
+    return len(state['messages']) == 1
+
+async def lookup_cached_answer(state: AgentState) -> Optional[str]:
+    """Knowledge-base questions: reuse the answer of an equivalent recent question"""
+    if should_use_tools(state) != "retrieve" or not is_standalone(state):
+        return None
+    
+    query_embedding = await retriever.embed_query_async(state['user_query'])
+    cached_answer = semantic_cache.lookup(query_embedding)
+    if cached_answer is not None:
+        print(f"[Animal Care Agent] Semantic cache hit for: {state['user_query']}")
+        return cached_answer
+    
+    # Let the retrieve node reuse the embedding instead of requesting it again
+    state["query_embedding"] = query_embedding
+    return None
+
+def store_cached_answer(state: AgentState, answer: str):
+    """Remember a freshly generated knowledge-base answer"""
+    # query_embedding is only set by lookup_cached_answer for cacheable (standalone)
+    # questions; checking messages here would be wrong, since nodes append to that list
+    if state["query_embedding"] is not None and answer:
+        semantic_cache.add(state["query_embedding"], answer)
+
+async def run_agent(user_query: str, session_id: str, user_id: str, history: List[Dict] = None) -> str:
+    """Run the agentic RAG pipeline for livestock assistance"""
+    initial_state = build_initial_state(user_query, session_id, user_id, history)
+    
+    cached_answer = await lookup_cached_answer(initial_state)
+    if cached_answer is not None:
+        return cached_answer
     
     # Run the agent
     print(f"[Animal Care Agent] Processing query: {user_query}")
-    result = agent.invoke(initial_state)
+    result = await agent.ainvoke(initial_state)
     
-    return result["final_answer"]
\ No newline at end of file
+    store_cached_answer(initial_state, result["final_answer"])
+    return result["final_answer"]
+
+async def stream_agent(user_query: str, session_id: str, user_id: str, history: List[Dict] = None) -> AsyncIterator[str]:
+    """Run the pipeline, yielding the answer piece by piece as the LLM produces it"""
+    initial_state = build_initial_state(user_query, session_id, user_id, history)
+    
+    cached_answer = await lookup_cached_answer(initial_state)
+    if cached_answer is not None:
+        yield cached_answer
+        return
+    
+    # Greeting / small-talk routes are produced without an LLM: nothing to stream, send them whole
+    if should_use_tools(initial_state) != "retrieve":
+        result = await agent.ainvoke(initial_state)
+        yield result["final_answer"]
+        return
+    
+    print(f"[Animal Care Agent] Streaming query: {user_query}")
+    streamed = []
+    final_answer = ""
+    async for event in agent.astream_events(initial_state, version="v1"):
+        if event["event"] == "on_chat_model_stream" and ANSWER_STREAM_TAG in event.get("tags", []):
+            content = event["data"]["chunk"].content
+            if content:
+                streamed.append(content)
+                yield content
+        elif event["event"] == "on_chain_end" and event["name"] == "generate_answer":
+            # The node's own output is its state; the graph's root output is not
+            output = event["data"].get("output")
+            if isinstance(output, dict):
+                final_answer = output.get("final_answer", "")
+    
+    final_answer = final_answer or "".join(streamed)
+    if not final_answer:
+        raise RuntimeError("Agent finished without producing an answer")
+    if not streamed:
+        yield final_answer
+    
+    store_cached_answer(initial_state, final_answer)
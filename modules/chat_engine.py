@@ -3,7 +3,8 @@
 import os
 # REMOVE this line: from dotenv import load_dotenv
 from modules.chat_history import get_chat_history, append_chat_history
-from modules.agent import run_agent
+from typing import AsyncIterator
+from modules.agent import run_agent, stream_agent
 
 # REMOVE this line: load_dotenv()
 
@@ -19,4 +20,19 @@ async def get_chat_response(user_query: str, session_id: str, user_id: str) -> s
     # Save to history
     await append_chat_history(session_id, user_query, response, user_id)
     
-    return response
\ No newline at end of file
+    return response
+
+async def stream_chat_response(user_query: str, session_id: str, user_id: str) -> AsyncIterator[str]:
+    """Stream the agent's response, saving it to history once complete"""
+    
+    # Load chat history
+    history_records = await get_chat_history(session_id)
+    
+    # Forward answer pieces as they are generated
+    pieces = []
+    async for piece in stream_agent(user_query, session_id, user_id, history_records):
+        pieces.append(piece)
+        yield piece
+    
+    # Save to history
+    await append_chat_history(session_id, user_query, "".join(pieces), user_id)
\ No newline at end of file
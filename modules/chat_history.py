@@ -6,10 +6,34 @@ from typing import List, Dict
 from asyncio import Lock
 from functools import partial
 from datetime import datetime, timedelta
+import redis.asyncio as redis
 
 HISTORY_FILE = "chat_data.json"
 history_lock = Lock()
 
+# Most recent turns handed to the agent
+HISTORY_WINDOW = 8
+# Redis keys expire after this many seconds without activity
+SESSION_TTL = int(os.getenv("CHAT_SESSION_TTL", 7 * 24 * 3600))
+# Turns kept per session in Redis (older ones are trimmed on append)
+HISTORY_MAX = int(os.getenv("CHAT_HISTORY_MAX", 100))
+
+# With REDIS_URL set, history and sessions live in Redis (shared by all server
+# workers, one round-trip per read/write); otherwise in chat_data.json
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = None
+if REDIS_URL:
+    redis_pool = redis.ConnectionPool.from_url(REDIS_URL, max_connections=32, decode_responses=True)
+    redis_client = redis.Redis(connection_pool=redis_pool)
+
+# Session registry for the file-backed mode (per process)
+local_sessions = {}
+
+async def close_chat_history():
+    """Close pooled Redis connections (on shutdown)"""
+    if redis_client is not None:
+        await redis_pool.disconnect()
+
 async def load_chat_data() -> Dict[str, Dict]:
     """Load chat data from JSON file"""
     async with history_lock:
@@ -32,26 +56,49 @@ async def save_chat_data(data: Dict[str, Dict]):
         with open(HISTORY_FILE, "w") as f:
             await loop.run_in_executor(None, partial(json.dump, data, f, indent=2))
 
+async def register_session(session_id: str, user_id: str):
+    """Record a new session and its owner"""
+    if redis_client is not None:
+        await redis_client.setex(f"session:{session_id}", SESSION_TTL, user_id)
+    else:
+        local_sessions[session_id] = {"user_id": user_id}
+
 async def get_chat_history(session_id: str) -> List[Dict[str, str]]:
-    """Get chat history for a session"""
+    """Get the most recent chat history for a session"""
+    if redis_client is not None:
+        records = await redis_client.lrange(f"chat:{session_id}", -HISTORY_WINDOW, -1)
+        return [json.loads(record) for record in records]
+
     data = await load_chat_data()
     session = data.get(session_id, {})
-    return session.get("conversations", [])
+    return session.get("conversations", [])[-HISTORY_WINDOW:]
 
 async def append_chat_history(session_id: str, user: str, bot: str, user_id: str):
     """Append a message to chat history"""
-    data = await load_chat_data()
-    if session_id not in data:
-        data[session_id] = {
-            "user_id": user_id,
-            "conversations": []
-        }
     # Bangladesh Time (UTC+6), 12-hour format with AM/PM
     bd_time = datetime.utcnow() + timedelta(hours=6)
     timestamp = bd_time.strftime('%Y-%m-%d %I:%M:%S %p')
-    data[session_id]["conversations"].append({
+    record = {
         "user": user,
         "bot": bot,
         "timestamp": timestamp
-    })
+    }
+
+    if redis_client is not None:
+        key = f"chat:{session_id}"
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.rpush(key, json.dumps(record, ensure_ascii=False))
+            pipe.ltrim(key, -max(HISTORY_MAX, HISTORY_WINDOW), -1)
+            pipe.expire(key, SESSION_TTL)
+            pipe.setex(f"session:{session_id}", SESSION_TTL, user_id)
+            await pipe.execute()
+        return
+
+    data = await load_chat_data()
+    if session_id not in data:
+        data[session_id] = {
+            "user_id": user_id,
+            "conversations": []
+        }
+    data[session_id]["conversations"].append(record)
     await save_chat_data(data)
\ No newline at end of file
@@ -0,0 +1,101 @@
+# embedding_batcher.py
+
+import asyncio
+import numpy as np
+from typing import Callable, Tuple, Any
+
+class EmbeddingBatcher:
+    """Coalesces concurrent embedding requests into one Azure call per short window"""
+
+    def __init__(self, get_client: Callable[[], Tuple[Any, str]], max_batch_size: int = 128, max_wait: float = 0.02,
+                 max_concurrency: int = 8):
+        # get_client returns (AsyncAzureOpenAI client, deployment name)
+        self._get_client = get_client
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_concurrency = max_concurrency
+
+        # Bound to the event loop that first uses the batcher
+        self._loop = None
+        self._queue = None
+        self._worker = None
+        self._semaphore = None  # caps in-flight requests to stay under Azure rate limits
+        self._pending = set()  # in-flight flush tasks (kept referenced until done)
+        self._collecting = []  # requests taken off the queue but not yet handed to a flush
+
+    def _ensure_worker(self):
+        """Start the collector task on the current event loop"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._worker is None or self._worker.done():
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._worker = loop.create_task(self._collect())
+
+    async def aclose(self):
+        """Stop the collector task; in-flight batches finish, queued and collecting requests are failed"""
+        worker, self._worker = self._worker, None
+        if worker is None or self._loop is not asyncio.get_running_loop():
+            return
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+        await asyncio.gather(*self._pending, return_exceptions=True)
+        unsent = self._collecting
+        self._collecting = []
+        while not self._queue.empty():
+            unsent.append(self._queue.get_nowait())
+        for _, future in unsent:
+            if not future.done():
+                future.set_exception(RuntimeError("Embedding batcher closed"))
+
+    async def embed(self, text: str) -> np.ndarray:
+        """Embedding of one text, sent to Azure together with other concurrent requests"""
+        self._ensure_worker()
+        future = self._loop.create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _collect(self):
+        """Gather requests for max_wait seconds, then send them as one batch"""
+        while True:
+            # Kept on self so aclose() can fail these if cancelled mid-collection
+            self._collecting = batch = [await self._queue.get()]
+            await asyncio.sleep(self.max_wait)  # let concurrent callers join this batch
+            while len(batch) < self.max_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            self._collecting = []
+
+            # Keep collecting the next batch while this one is in flight
+            task = asyncio.create_task(self._flush(batch))
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+
+    async def _flush(self, batch):
+        """Embed a batch in a single request and resolve each caller's future.
+        A failed batch is split and retried, so one bad input only fails its own caller"""
+        try:
+            client, deployment = self._get_client()
+            async with self._semaphore:
+                response = await client.embeddings.create(
+                    model=deployment,
+                    input=[text for text, _ in batch]
+                )
+        except Exception as e:
+            if len(batch) > 1:
+                middle = len(batch) // 2
+                await asyncio.gather(self._flush(batch[:middle]), self._flush(batch[middle:]))
+                return
+            _, future = batch[0]
+            if not future.done():
+                future.set_exception(e)
+            return
+
+        for data in response.data:
+            future = batch[data.index][1]
+            if not future.done():
+                future.set_result(np.array(data.embedding, dtype='float32'))
+
+        # Never leave a caller waiting on a short response
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(RuntimeError("Embeddings response is missing this input"))
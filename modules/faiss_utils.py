@@ -0,0 +1,31 @@
+# faiss_utils.py
+
+import os
+import logging
+import faiss
+
+logger = logging.getLogger(__name__)
+
+def use_gpu() -> bool:
+    """GPU offload is opt-in (USE_FAISS_GPU=1) and needs a CUDA build of FAISS"""
+    if os.getenv("USE_FAISS_GPU", "").lower() not in ("1", "true", "yes"):
+        return False
+    return hasattr(faiss, "StandardGpuResources") and faiss.get_num_gpus() > 0
+
+def index_to_gpu(index):
+    """Move an index to GPU 0 when enabled. Returns (index, gpu_resources)"""
+    if not use_gpu():
+        return index, None
+    try:
+        res = faiss.StandardGpuResources()
+        return faiss.index_cpu_to_gpu(res, 0, index), res
+    except RuntimeError as e:
+        # HNSW and a few other index types have no GPU implementation
+        logger.warning("⚠️  Keeping FAISS index on CPU: %s", e)
+        return index, None
+
+def index_to_cpu(index):
+    """Copy a GPU index back to CPU (write_index only accepts CPU indexes)"""
+    if hasattr(faiss, "GpuIndex") and isinstance(index, faiss.GpuIndex):
+        return faiss.index_gpu_to_cpu(index)
+    return index
@@ -1,53 +1,219 @@
 # index_builder.py
 
 import os
+import sys
 import faiss
-import pickle
 import json
 import glob
+import re
+import asyncio
+import hashlib
 import numpy as np
+import pyarrow as pa
+from bisect import bisect_right
 from tqdm import tqdm
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI
 from dotenv import load_dotenv
+from tenacity import retry, stop_after_attempt, wait_exponential
+from modules.faiss_utils import index_to_gpu, index_to_cpu
+from modules.metadata_store import read_metadata, write_metadata
+
+# Azure accepts up to 2048 inputs per embeddings request
+EMBEDDING_BATCH_SIZE = 64
+# Max in-flight embedding requests (keeps us under the deployment's TPM/RPM)
+EMBEDDING_CONCURRENCY = 16
+
+# FAISS index settings
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+PQ_DIMS_PER_SUBQUANTIZER = 16   # 1536 dims -> 96 sub-vectors
+PQ_BITS = 8
+
+# Output files
+INDEX_PATH = "vector_store/kb_index.faiss"
+METADATA_PATH = "vector_store/kb_metadata.arrow"
+# Normalized float32 vectors, one row per metadata row. Kept at full precision
+# (the index itself may be quantized) so rebuilds can reuse unchanged chunks.
+EMBEDDINGS_PATH = "vector_store/kb_embeddings.npy"
+
+def convert_metadata(src_path, dst_path=METADATA_PATH):
+    """Convert metadata from an older build (.pkl / .parquet) to Arrow IPC without re-embedding"""
+    write_metadata(read_metadata(src_path), dst_path)
+    print(f"💾 Converted {src_path} -> {dst_path}")
 
 class KnowledgeEmbedder:
     def __init__(self, json_dir="./pdf_file"):
         self.json_dir = json_dir
-        self.embedding_client = AzureOpenAI(
-            api_key=os.getenv("AZURE_EMBEDDING_KEY"),
-            api_version="2023-05-15",
-            azure_endpoint=os.getenv("AZURE_EMBEDDING_URL")
-        )
+        # Created on first use, so reindex() works without Azure credentials
+        self._embedding_client = None
         self.embedding_deployment = os.getenv("AZURE_EMBEDDING_DEPLOYMENT", "text-embedding-ada-002")
         self.index = None
+        self._gpu_res = None
+        self.embeddings = None
         self.knowledge_data = []
 
-    def _get_embeddings(self, texts):
-        """Get embeddings for a batch of texts"""
-        embeddings = []
-        batch_size = 16
-        
-        for i in tqdm(range(0, len(texts), batch_size), desc="Generating embeddings"):
-            batch = texts[i:i+batch_size]
-            try:
-                response = self.embedding_client.embeddings.create(
-                    model=self.embedding_deployment,
-                    input=batch
-                )
-                batch_embeddings = [np.array(data.embedding).astype('float32') for data in response.data]
-                embeddings.extend(batch_embeddings)
-            except Exception as e:
-                print(f"Error processing batch {i}: {e}")
-                # Add zero vectors for failed batches
-                embeddings.extend([np.zeros(1536).astype('float32')] * len(batch))
-        
-        return np.array(embeddings)
+    @property
+    def embedding_client(self):
+        """Azure OpenAI client for embedding requests"""
+        if self._embedding_client is None:
+            self._embedding_client = AsyncAzureOpenAI(
+                api_key=os.getenv("AZURE_EMBEDDING_KEY"),
+                api_version="2023-05-15",
+                azure_endpoint=os.getenv("AZURE_EMBEDDING_URL")
+            )
+        return self._embedding_client
+
+    def _content_hash(self, text):
+        """Identifies a text's embedding (the deployment is part of the key)"""
+        key = f"{self.embedding_deployment}\n{text}".encode("utf-8")
+        return hashlib.blake2b(key, digest_size=16).hexdigest()
+
+    def _load_embedding_cache(self, metadata_path, embeddings_path):
+        """Map content hash -> vector from the previous build, if there is one"""
+        if not (os.path.exists(metadata_path) and os.path.exists(embeddings_path)):
+            return {}
+        try:
+            hashes = read_metadata(metadata_path).column("content_hash").to_pylist()
+        except (KeyError, pa.ArrowInvalid):
+            return {}  # built before content hashes were stored
+        vectors = np.load(embeddings_path, mmap_mode="r")
+        if len(vectors) != len(hashes):
+            return {}
+        return {h: vectors[row] for row, h in enumerate(hashes)}
+
+    @retry(stop=stop_after_attempt(5), wait=wait_exponential(multiplier=1, min=1, max=30), reraise=True)
+    async def _embed_batch(self, batch):
+        """Embed a single batch, retrying with exponential backoff"""
+        response = await self.embedding_client.embeddings.create(
+            model=self.embedding_deployment,
+            input=batch
+        )
+        return [data.embedding for data in response.data]
+
+    async def _get_embeddings(self, texts, batch_size=EMBEDDING_BATCH_SIZE):
+        """Get embeddings for all texts, running batches concurrently"""
+        semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+        starts = list(range(0, len(texts), batch_size))
+        progress = tqdm(total=len(starts), desc="Generating embeddings")
+        # One contiguous float32 matrix; allocated once the first batch reveals the dimension
+        out = None
+
+        async def embed(start):
+            nonlocal out
+            async with semaphore:
+                vectors = await self._embed_batch(texts[start:start+batch_size])
+            if out is None:
+                out = np.empty((len(texts), len(vectors[0])), dtype=np.float32)
+            # Each batch writes its own rows, so completion order doesn't matter
+            out[start:start+len(vectors)] = vectors
+            progress.update(1)
+
+        results = await asyncio.gather(*(embed(start) for start in starts), return_exceptions=True)
+        progress.close()
+
+        for start, result in zip(starts, results):
+            if isinstance(result, Exception):
+                raise RuntimeError(f"Embedding batch {start} failed after retries: {result}") from result
+
+        return out
+
+    @staticmethod
+    def _pq_subquantizers(dim):
+        """Largest divisor of dim giving sub-vectors of at least PQ_DIMS_PER_SUBQUANTIZER dims"""
+        for m in range(max(1, dim // PQ_DIMS_PER_SUBQUANTIZER), 0, -1):
+            if dim % m == 0:
+                return m
+        return 1
+
+    def _build_index(self, embeddings):
+        """Build the FAISS index selected by FAISS_INDEX_TYPE (hnsw_sq8, hnsw, sq8, ivfflat, ivfpq or flat)"""
+        index_type = os.getenv("FAISS_INDEX_TYPE", "hnsw_sq8").lower()
+        n, dim = embeddings.shape
+
+        # Unit vectors make inner product equal to cosine similarity
+        faiss.normalize_L2(embeddings)
+
+        # PQ training needs at least 2^bits points per centroid
+        if index_type == "ivfpq" and n < 2 ** PQ_BITS:
+            print(f"⚠️  Only {n} vectors, too few to train IVFPQ; using HNSW-SQ8 instead")
+            index_type = "hnsw_sq8"
+
+        # PQ needs the dimension split evenly into sub-vectors
+        pq_m = self._pq_subquantizers(dim)
+        if index_type == "ivfpq" and pq_m < 2:
+            print(f"⚠️  Can't split {dim} dimensions into PQ sub-vectors; using HNSW-SQ8 instead")
+            index_type = "hnsw_sq8"
+
+        # int8 scalar quantization stores 1 byte per dimension instead of 4
+        sq8 = faiss.ScalarQuantizer.QT_8bit
+
+        if index_type == "ivfpq":
+            nlist = max(1, int(np.sqrt(n)))
+            quantizer = faiss.IndexFlatIP(dim)
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, PQ_BITS, faiss.METRIC_INNER_PRODUCT)
+        elif index_type == "ivfflat":
+            # Exact vectors, searched in nprobe of ~sqrt(N) clusters (FAISS_NPROBE at query time)
+            nlist = max(1, int(np.sqrt(n)))
+            quantizer = faiss.IndexFlatIP(dim)
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        elif index_type == "flat":
+            index = faiss.IndexFlatIP(dim)
+        elif index_type == "sq8":
+            index = faiss.IndexScalarQuantizer(dim, sq8, faiss.METRIC_INNER_PRODUCT)
+        else:
+            if index_type == "hnsw":
+                index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            else:
+                index_type = "hnsw_sq8"
+                index = faiss.IndexHNSWSQ(dim, sq8, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+            # efSearch is serialized with the index, so the retriever picks it up on load
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+
+        # Train and add on GPU when available (USE_FAISS_GPU)
+        index, self._gpu_res = index_to_gpu(index)
+        if not index.is_trained:
+            index.train(embeddings)
+        index.add(embeddings)
+        print(f"🧭 Built {index_type} index with {index.ntotal} vectors")
+        if "sq8" in index_type and hasattr(faiss, "supported_instruction_sets"):
+            # The int8 distance kernels are only fast with AVX2 / AVX-512 / NEON builds
+            print(f"   FAISS SIMD support: {', '.join(sorted(faiss.supported_instruction_sets()))}")
+        return index
+
+    def reindex(self, index_path=INDEX_PATH, embeddings_path=EMBEDDINGS_PATH):
+        """Rebuild the index with the current FAISS_INDEX_TYPE from stored vectors, without re-embedding"""
+        if os.path.exists(embeddings_path):
+            embeddings = np.array(np.load(embeddings_path), dtype='float32')
+        else:
+            # Builds older than kb_embeddings.npy: read the vectors back out of the index
+            old_index = faiss.read_index(index_path)
+            ivf = faiss.try_extract_index_ivf(old_index)
+            if ivf is not None:
+                ivf.make_direct_map()
+            embeddings = old_index.reconstruct_n(0, old_index.ntotal)
+
+        self.index = self._build_index(embeddings)
+        faiss.write_index(index_to_cpu(self.index), index_path)
+        print(f"💾 Saved FAISS index to: {index_path}")
+
+    @staticmethod
+    def _last_boundary(positions, start, limit):
+        """Largest position p with start <= p <= limit, or -1 (same as str.rfind)"""
+        i = bisect_right(positions, limit) - 1
+        return positions[i] if i >= 0 and positions[i] >= start else -1
 
     def _split_text(self, text, chunk_size=800, chunk_overlap=100):
         """Simple text splitter"""
         if len(text) <= chunk_size:
             return [text]
         
+        # Find every candidate boundary once instead of rescanning each window
+        periods = [m.start() for m in re.finditer(r'\. ', text)]
+        dandas = [m.start() for m in re.finditer(r'। ', text)]  # Bengali full stop
+        spaces = [m.start() for m in re.finditer(r' ', text)]
+        
         chunks = []
         start = 0
         
@@ -60,22 +226,23 @@ class KnowledgeEmbedder:
                 chunks.append(text[start:])
                 break
             
-            # Try to split at sentence boundary
-            split_point = text.rfind('. ', start, end)
+            # Try to split at sentence boundary (the separator must fit before end)
+            split_point = self._last_boundary(periods, start, end - 2)
             if split_point == -1:
-                split_point = text.rfind('। ', start, end)  # Bengali full stop
+                split_point = self._last_boundary(dandas, start, end - 2)
             if split_point == -1:
-                split_point = text.rfind(' ', start, end)
+                split_point = self._last_boundary(spaces, start, end - 1)
             if split_point == -1 or split_point < start + chunk_size * 0.7:
                 split_point = end
             
             chunks.append(text[start:split_point].strip())
-            start = split_point - chunk_overlap
+            # Always move forward, even if chunk_overlap is close to chunk_size
+            start = max(split_point - chunk_overlap, start + 1)
         
         return chunks
 
-    def process_json(self):
-        """Load and process JSON files"""
+    def process_json(self, metadata_path=METADATA_PATH, embeddings_path=EMBEDDINGS_PATH):
+        """Load and process JSON files, reusing embeddings of unchanged chunks from the last build"""
         print(f"🔍 Loading JSON files from: {self.json_dir}")
         
         json_files = glob.glob(os.path.join(self.json_dir, "*.json"))
@@ -87,6 +254,7 @@ class KnowledgeEmbedder:
         print(f"📂 Found {len(json_files)} JSON files")
         
         all_texts = []
+        all_hashes = []
         all_metadata = []
         
         for json_file in tqdm(json_files, desc="Processing files"):
@@ -115,16 +283,19 @@ class KnowledgeEmbedder:
                     for chunk_idx, chunk in enumerate(chunks):
                         # Create combined text for embedding (like CSV's combined_text)
                         combined_text = f"{header or filename}. {chunk}"
+                        content_hash = self._content_hash(combined_text)
                         all_texts.append(combined_text)
+                        all_hashes.append(content_hash)
                         
                         # Store metadata (matching your CSV structure)
                         metadata = {
                             "ki_topic": header or filename,
                             "ki_text": chunk,
                             "source_file": filename,
-                            "page": str(page),
+                            "page": "" if page is None else str(page),
                             "chunk_index": chunk_idx,
-                            "total_chunks": len(chunks)
+                            "total_chunks": len(chunks),
+                            "content_hash": content_hash
                         }
                         all_metadata.append(metadata)
                         
@@ -138,32 +309,73 @@ class KnowledgeEmbedder:
             print("❌ No text extracted from JSON files")
             return
         
+        # Embed each distinct text once, then scatter the vectors back to every chunk
+        slots = {}
+        unique_texts = []
+        unique_hashes = []
+        positions = []
+        for text, content_hash in zip(all_texts, all_hashes):
+            slot = slots.get(content_hash)
+            if slot is None:
+                slot = slots[content_hash] = len(unique_texts)
+                unique_texts.append(text)
+                unique_hashes.append(content_hash)
+            positions.append(slot)
+        
+        # Only chunks that are new or changed since the last build need the API
+        cache = self._load_embedding_cache(metadata_path, embeddings_path)
+        missing = [i for i, content_hash in enumerate(unique_hashes) if content_hash not in cache]
+        print(f"♻️  Reusing {len(unique_texts) - len(missing)} embeddings from the previous build")
+        
         # Generate embeddings
-        print(f"🔢 Generating embeddings for {len(all_texts)} entries...")
-        embeddings = self._get_embeddings(all_texts)
+        new_embeddings = None
+        if missing:
+            print(f"🔢 Generating embeddings for {len(missing)} unique entries ({len(all_texts)} total)...")
+            new_embeddings = asyncio.run(self._get_embeddings([unique_texts[i] for i in missing]))
         
-        # Build FAISS index
-        dim = embeddings.shape[1]
-        self.index = faiss.IndexFlatL2(dim)
-        self.index.add(embeddings)
+        dim = new_embeddings.shape[1] if missing else len(next(iter(cache.values())))
+        unique_embeddings = np.empty((len(unique_texts), dim), dtype=np.float32)
+        if missing:
+            unique_embeddings[missing] = new_embeddings
+        for i, content_hash in enumerate(unique_hashes):
+            if content_hash in cache:
+                unique_embeddings[i] = cache[content_hash]
+        embeddings = np.take(unique_embeddings, positions, axis=0)
+        
+        # Build FAISS index (normalizes the embeddings in place)
+        self.index = self._build_index(embeddings)
+        self.embeddings = embeddings
         
         # Save metadata for retrieval
         self.knowledge_data = all_metadata
         print("✅ Embedding complete.")
 
-    def save_to_disk(self, index_path="vector_store/kb_index.faiss", metadata_path="vector_store/kb_metadata.pkl"):
+    def save_to_disk(self, index_path=INDEX_PATH, metadata_path=METADATA_PATH, embeddings_path=EMBEDDINGS_PATH):
         os.makedirs(os.path.dirname(index_path), exist_ok=True)
 
-        faiss.write_index(self.index, index_path)
+        faiss.write_index(index_to_cpu(self.index), index_path)
         print(f"💾 Saved FAISS index to: {index_path}")
 
-        with open(metadata_path, "wb") as f:
-            pickle.dump(self.knowledge_data, f)
+        # Columnar storage; the retriever memory-maps it
+        write_metadata(pa.Table.from_pylist(self.knowledge_data), metadata_path)
         print(f"💾 Saved metadata to: {metadata_path}")
 
+        np.save(embeddings_path, self.embeddings)
+        print(f"💾 Saved embeddings to: {embeddings_path}")
+
 
 if __name__ == "__main__":
     load_dotenv()
+
+    # python -m modules.index_builder convert-metadata <old metadata file>
+    if len(sys.argv) == 3 and sys.argv[1] == "convert-metadata":
+        convert_metadata(sys.argv[2])
+        sys.exit(0)
+
+    # python -m modules.index_builder reindex  (switch FAISS_INDEX_TYPE without re-embedding)
+    if len(sys.argv) == 2 and sys.argv[1] == "reindex":
+        KnowledgeEmbedder().reindex()
+        sys.exit(0)
     
     # Use JSON directory instead of CSV
     embedder = KnowledgeEmbedder(json_dir="./pdf_file")
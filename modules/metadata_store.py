@@ -0,0 +1,23 @@
+# metadata_store.py
+
+import pickle
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+def read_metadata(path: str) -> pa.Table:
+    """Load a metadata table from Arrow IPC, Parquet or a legacy pickled list of dicts"""
+    if path.endswith(".arrow"):
+        # Uncompressed IPC file: columns point straight into the shared mapping
+        with pa.memory_map(path) as source:
+            return pa.ipc.open_file(source).read_all()
+    if path.endswith(".parquet"):
+        return pq.read_table(path, memory_map=True)
+    # Pickled list of dicts written by older index builds
+    with open(path, "rb") as f:
+        return pa.Table.from_pylist(pickle.load(f))
+
+def write_metadata(table: pa.Table, path: str):
+    """Write metadata as an uncompressed Arrow IPC file, so the retriever can memory-map it zero-copy"""
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
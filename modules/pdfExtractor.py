@@ -5,11 +5,30 @@ from pathlib import Path
 import pdfplumber
 from tqdm import tqdm
 import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # Configuration
 PDF_DATA_DIR = "./pdf_data"
 JSON_OUTPUT_DIR = "./pdf_file"
 
+# Precompiled patterns (these run for every page and section of every PDF)
+# Keep Bengali characters, English letters, numbers, and basic punctuation
+# Bengali Unicode range: \u0980-\u09FF
+# Basic punctuation: . , ! ? ; : - ( ) [ ] { } ' " ... । (Bengali danda)
+_ALLOWED_CHARS_RE = re.compile(r'[^\u0980-\u09FFa-zA-Z0-9\s\.\,\!\?\;\:\-\_\(\)\[\]\{\}\'\""।…]')
+_WS_RE = re.compile(r'\s+')
+_SPACE_BEFORE_PUNCT_RE = re.compile(r'\s+([।.,!?;:])')
+# Table of contents / page-number markers, as one alternation
+_TOC_RE = re.compile(
+    r'contents|table of contents|index|সূচিপত্র|মুখবন্ধ'
+    r'|page\s+\d+|\d+\s+of\s+\d+'
+    r'|^\d+$',  # Just page numbers
+    re.IGNORECASE
+)
+_PARA_SPLIT_RE = re.compile(r'\n\s*\n')
+# Different sentence endings for Bengali and English
+_SENTENCE_END_RE = re.compile(r'[।?!\.]\s+')
+
 def clean_text_content(text):
     """
     Clean text by removing special characters and unwanted spaces
@@ -18,20 +37,15 @@ def clean_text_content(text):
     if not text:
         return text
     
-    # Keep Bengali characters, English letters, numbers, and basic punctuation
-    # Bengali Unicode range: \u0980-\u09FF
-    # Basic punctuation: . , ! ? ; : - ( ) [ ] { } ' " ... । (Bengali danda)
-    allowed_chars_pattern = r'[^\u0980-\u09FFa-zA-Z0-9\s\.\,\!\?\;\:\-\_\(\)\[\]\{\}\'\""।…]'
-    
     # Remove special characters
-    cleaned_text = re.sub(allowed_chars_pattern, '', text)
+    cleaned_text = _ALLOWED_CHARS_RE.sub('', text)
     
     # Remove extra whitespaces (multiple spaces, tabs, newlines)
-    cleaned_text = re.sub(r'\s+', ' ', cleaned_text)
+    cleaned_text = _WS_RE.sub(' ', cleaned_text)
     
-    # Clean up space around punctuation
-    cleaned_text = re.sub(r'\s+([।.,!?;:])', r'\1', cleaned_text)  # Remove space before punctuation
-    cleaned_text = re.sub(r'([।.,!?;:])\s+', r'\1 ', cleaned_text)  # Ensure space after punctuation
+    # Remove space before punctuation. Whitespace runs are already single
+    # spaces here, so the space after punctuation needs no further fixing.
+    cleaned_text = _SPACE_BEFORE_PUNCT_RE.sub(r'\1', cleaned_text)
     
     # Remove spaces at the beginning and end
     cleaned_text = cleaned_text.strip()
@@ -63,20 +77,21 @@ def extract_text_with_pdfplumber(pdf_path):
 
 def clean_extracted_text(text):
     """Clean and normalize extracted text"""
-    # Remove extra whitespaces and normalize newlines
-    text = re.sub(r'\s+', ' ', text)
-    text = text.strip()
-    
-    # Apply additional cleaning to remove special characters
-    text = clean_text_content(text)
-    
-    return text
+    # clean_text_content also collapses whitespace/newlines and strips, so a
+    # separate whitespace pass up front would be redundant
+    return clean_text_content(text)
 
 def detect_language(text):
     """Detect if text is primarily Bengali, English, or mixed"""
-    bengali_chars = len(re.findall(r'[\u0980-\u09FF]', text))
-    english_chars = len(re.findall(r'[a-zA-Z]', text))
-    total_chars = len(re.findall(r'[a-zA-Z\u0980-\u09FF]', text)) or 1
+    # Single pass over the string, counting by code point range
+    bengali_chars = english_chars = 0
+    for ch in text:
+        code = ord(ch)
+        if 0x0980 <= code <= 0x09FF:
+            bengali_chars += 1
+        elif 65 <= code <= 90 or 97 <= code <= 122:
+            english_chars += 1
+    total_chars = (bengali_chars + english_chars) or 1
     
     bengali_ratio = bengali_chars / total_chars
     english_ratio = english_chars / total_chars
@@ -94,24 +109,14 @@ def is_content_rich(text, min_length=50):
         return False
     
     # Check if it's likely a table of contents or page number
-    toc_patterns = [
-        r'contents|table of contents|index|সূচিপত্র|মুখবন্ধ',
-        r'page\s+\d+|\d+\s+of\s+\d+',
-        r'^\d+$'  # Just page numbers
-    ]
-    
-    for pattern in toc_patterns:
-        if re.search(pattern, text.lower()):
-            return False
-    
-    return True
+    return not _TOC_RE.search(text)
 
 def split_into_sections(text, max_length=800):
     """Split text into logical sections for both Bengali and English"""
     sections = []
     
     # Split by paragraphs (double newlines)
-    paragraphs = re.split(r'\n\s*\n', text)
+    paragraphs = _PARA_SPLIT_RE.split(text)
     
     current_section = ""
     
@@ -136,9 +141,7 @@ def split_into_sections(text, max_length=800):
     
     # If no sections were created but we have content, split by sentences
     if not sections and text.strip() and is_content_rich(text):
-        # Different sentence endings for Bengali and English
-        sentence_endings = r'[।?!\.]\s+'
-        sentences = re.split(sentence_endings, text)
+        sentences = _SENTENCE_END_RE.split(text)
         
         current_chunk = ""
         
@@ -256,16 +259,23 @@ def main():
     total_entries = 0
     successful_conversions = 0
     
-    for pdf_file in tqdm(pdf_files, desc="Processing PDFs"):
-        try:
-            entries_count = process_pdf_to_json(pdf_file)
-            if entries_count:
-                total_entries += entries_count
-                successful_conversions += 1
-            else:
-                print(f"  ⚠️  No valid content extracted from {Path(pdf_file).stem}")
-        except Exception as e:
-            print(f"❌ Error processing {pdf_file}: {e}")
+    # PDF parsing is CPU-bound, so convert files in parallel worker processes
+    # (each worker writes its own JSON file and only returns the entry count)
+    max_workers = min(len(pdf_files), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(process_pdf_to_json, pdf_file): pdf_file for pdf_file in pdf_files}
+        
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing PDFs"):
+            pdf_file = futures[future]
+            try:
+                entries_count = future.result()
+                if entries_count:
+                    total_entries += entries_count
+                    successful_conversions += 1
+                else:
+                    print(f"  ⚠️  No valid content extracted from {Path(pdf_file).stem}")
+            except Exception as e:
+                print(f"❌ Error processing {pdf_file}: {e}")
     
     print("\n" + "=" * 60)
     print("📊 Conversion Summary:")
@@ -1,12 +1,47 @@
 # retriever.py
 
 import os
+import re
+import asyncio
+import hashlib
+import logging
+import unicodedata
+import threading
 import faiss
-import pickle
+import httpx
 import numpy as np
-from typing import List, Dict, Any
-from openai import AzureOpenAI
-from sklearn.metrics.pairwise import cosine_similarity
+import pyarrow as pa
+import pyarrow.compute as pc
+from collections import namedtuple
+from contextlib import nullcontext
+from typing import List, Dict, Any, Optional
+from openai import AzureOpenAI, AsyncAzureOpenAI
+from modules.faiss_utils import index_to_gpu
+from modules.metadata_store import read_metadata
+from modules.embedding_batcher import EmbeddingBatcher
+from modules.query_cache import QueryCache
+
+logger = logging.getLogger(__name__)
+
+# A search result: row in the index/metadata and its cosine similarity
+Hit = namedtuple("Hit", "idx similarity")
+
+# OpenMP threads per FAISS search. Single queries run concurrently in worker
+# threads, so 1 avoids oversubscription; large batches get more cores.
+FAISS_NUM_THREADS = int(os.getenv("FAISS_NUM_THREADS", "1"))
+FAISS_BATCH_THREADS = int(os.getenv("FAISS_BATCH_THREADS", str(os.cpu_count() or 1)))
+BATCH_THREADS_MIN_QUERIES = 32
+
+# Persistent HTTP/2 connections to the embeddings endpoint: concurrent requests
+# are multiplexed instead of each paying for its own TLS handshake
+HTTP_TIMEOUT = 10.0
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+
+_WS_RE = re.compile(r"\s+")
+
+def _canonicalize(text: str) -> str:
+    """Cache key for a query: trivial variants (case, spacing, Unicode forms) share one entry"""
+    return _WS_RE.sub(" ", unicodedata.normalize("NFKC", text)).strip().lower()
 
 class VectorRetriever:
     def __init__(self, index_path: str, metadata_path: str):
@@ -16,9 +51,18 @@ class VectorRetriever:
         # Don't initialize client immediately
         self._embedding_client = None
         self._embedding_deployment = None
+        self._async_embedding_client = None
+        # Concurrent async queries share one embeddings request
+        self._batcher = EmbeddingBatcher(self._get_async_embedding_client)
+        # Repeated queries skip the embeddings API (and, for results, the FAISS search)
+        self._emb_cache = QueryCache(max_size=2000, ttl=3600)
+        self._result_cache = QueryCache(max_size=1000, ttl=300)
         
         self.index = None
+        self._gpu_res = None
+        self._search_lock = nullcontext()
         self.knowledge_data = None
+        self._metadata_columns = {}
         self._load_index_and_metadata()
 
     def _get_embedding_client(self):
@@ -33,105 +77,305 @@ class VectorRetriever:
             self._embedding_client = AzureOpenAI(
                 api_key=api_key,
                 api_version="2023-05-15",
-                azure_endpoint=azure_endpoint
+                azure_endpoint=azure_endpoint,
+                http_client=httpx.Client(
+                    timeout=HTTP_TIMEOUT,
+                    transport=httpx.HTTPTransport(http2=True, limits=HTTP_LIMITS, retries=2)
+                )
             )
             self._embedding_deployment = os.getenv("AZURE_EMBEDDING_DEPLOYMENT", "text-embedding-ada-002")
         
         return self._embedding_client, self._embedding_deployment
 
+    def _get_async_embedding_client(self):
+        """Get async Azure OpenAI client (used by the embedding batcher)"""
+        if self._async_embedding_client is None:
+            api_key = os.getenv("AZURE_EMBEDDING_KEY")
+            azure_endpoint = os.getenv("AZURE_EMBEDDING_URL")
+            
+            if not api_key or not azure_endpoint:
+                raise ValueError("Missing Azure OpenAI credentials")
+            
+            self._async_embedding_client = AsyncAzureOpenAI(
+                api_key=api_key,
+                api_version="2023-05-15",
+                azure_endpoint=azure_endpoint,
+                http_client=httpx.AsyncClient(
+                    timeout=HTTP_TIMEOUT,
+                    transport=httpx.AsyncHTTPTransport(http2=True, limits=HTTP_LIMITS, retries=2)
+                )
+            )
+            self._embedding_deployment = os.getenv("AZURE_EMBEDDING_DEPLOYMENT", "text-embedding-ada-002")
+        
+        return self._async_embedding_client, self._embedding_deployment
+
+    async def aclose(self):
+        """Stop the embedding batcher and close the pooled HTTP connections of both embedding clients"""
+        await self._batcher.aclose()
+        if self._embedding_client is not None:
+            self._embedding_client.close()
+            self._embedding_client = None
+        if self._async_embedding_client is not None:
+            await self._async_embedding_client.close()
+            self._async_embedding_client = None
+
     def _load_index_and_metadata(self):
         """Load FAISS index and metadata"""
         if not os.path.exists(self.index_path):
             raise FileNotFoundError(f"FAISS index not found at {self.index_path}")
-        self.index = faiss.read_index(self.index_path)
+        # Memory-map the index file where the index type supports it
+        index = faiss.read_index(self.index_path, faiss.IO_FLAG_MMAP)
+        if index.metric_type != faiss.METRIC_INNER_PRODUCT:
+            index = self._to_inner_product(index)
+        self.index = index
+        self._configure_search()
+        # Search on GPU when enabled (USE_FAISS_GPU); the host copy is not kept
+        self.index, self._gpu_res = index_to_gpu(index)
+        if self._gpu_res is not None:
+            # GPU indexes are not thread-safe, even for search (CPU ones are);
+            # retrieve() runs in worker threads, so serialize access to the device
+            self._search_lock = threading.Lock()
+            logger.info("🚀 FAISS search on GPU (%d vectors)", self.index.ntotal)
 
         if not os.path.exists(self.metadata_path):
             raise FileNotFoundError(f"Metadata file not found at {self.metadata_path}")
-        with open(self.metadata_path, "rb") as f:
-            self.knowledge_data = pickle.load(f)
+        # Metadata is kept as an Arrow table; rows are materialized only for hits
+        self.knowledge_data = read_metadata(self.metadata_path)
+        self.knowledge_data = self._normalize_pages(self.knowledge_data)
+        self._metadata_columns = dict(zip(self.knowledge_data.column_names, self.knowledge_data.columns))
+
+    @staticmethod
+    def _normalize_pages(table: pa.Table) -> pa.Table:
+        """Older builds stored missing pages as the string 'None'; store them as ''"""
+        if "page" not in table.column_names:
+            return table
+        page = table.column("page")
+        if not pa.types.is_string(page.type) or not pc.any(pc.equal(page, "None")).as_py():
+            return table
+        fixed = pc.if_else(pc.equal(page, "None"), "", page)
+        return table.set_column(table.column_names.index("page"), "page", fixed)
+
+    @staticmethod
+    def _to_inner_product(index) -> faiss.Index:
+        """Convert a legacy L2 index into a normalized inner-product index, so search distances are cosine similarities"""
+        logger.warning("⚠️ Converting legacy L2 index (%d vectors) to inner product; rebuild the index to skip this step",
+                       index.ntotal)
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            # reconstruct_n() on IVF indexes needs the id -> list mapping
+            ivf.make_direct_map()
+        vectors = index.reconstruct_n(0, index.ntotal)
+        faiss.normalize_L2(vectors)
+        if os.getenv("FAISS_QUANTIZE_LEGACY_INDEX", "").lower() in ("1", "true", "yes"):
+            # Opt-in: 1 byte per dimension, but scores become approximate. Off by default so
+            # loading stays exact and deterministic; `reindex` is the way to switch index type
+            ip_index = faiss.IndexScalarQuantizer(index.d, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+            ip_index.train(vectors)
+        else:
+            ip_index = faiss.IndexFlatIP(index.d)
+        ip_index.add(vectors)
+        return ip_index
+
+    def _metadata_row(self, idx: int) -> Dict[str, Any]:
+        """Metadata of one indexed chunk as a dict"""
+        return {name: column[idx].as_py() for name, column in self._metadata_columns.items()}
+
+    def _configure_search(self):
+        """Apply search-time parameters for approximate (HNSW / IVF) indexes"""
+        if hasattr(self.index, "hnsw"):
+            ef_search = os.getenv("FAISS_EF_SEARCH")
+            if ef_search:
+                self.index.hnsw.efSearch = int(ef_search)
+
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None:
+            # nprobe is not stored in the index file
+            ivf.nprobe = int(os.getenv("FAISS_NPROBE", "16"))
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        """Unit-length float32 copy of an embedding"""
+        vec = np.array(embedding, dtype='float32').ravel()
+        vec /= np.linalg.norm(vec) + 1e-12
+        return vec
 
     def _get_embedding(self, text: str) -> np.ndarray:
         """Get embedding from Azure OpenAI"""
+        key = _canonicalize(text)
+        cached = self._emb_cache.get(key)
+        if cached is not None:
+            return cached
+
         client, deployment = self._get_embedding_client()
         
         response = client.embeddings.create(
             model=deployment,
             input=text
         )
-        return np.array(response.data[0].embedding).astype('float32')
+        embedding = self._normalize(response.data[0].embedding)
+        self._emb_cache.put(key, embedding)
+        return embedding
+
+    def embed_query(self, query: str) -> np.ndarray:
+        """Public access to the (unit-length) query embedding, so callers can reuse it in retrieve()"""
+        return self._get_embedding(query)
+
+    async def embed_query_async(self, query: str) -> np.ndarray:
+        """Async query embedding, micro-batched with other concurrent queries"""
+        key = _canonicalize(query)
+        cached = self._emb_cache.get(key)
+        if cached is not None:
+            return cached
+
+        embedding = self._normalize(await self._batcher.embed(query))
+        self._emb_cache.put(key, embedding)
+        return embedding
+
+    def get_cache_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Hit/miss statistics of the embedding and result caches"""
+        return {
+            "embeddings": self._emb_cache.stats(),
+            "results": self._result_cache.stats(),
+        }
+
+    def _get_embeddings_batch(self, texts: List[str]) -> np.ndarray:
+        """Embeddings of several texts as an (N, d) array; cache misses go out in one request"""
+        keys = [_canonicalize(text) for text in texts]
+        embeddings = [self._emb_cache.get(key) for key in keys]
+        missing = [i for i, emb in enumerate(embeddings) if emb is None]
+
+        if missing:
+            client, deployment = self._get_embedding_client()
+            # The embeddings API accepts up to 2048 inputs per request
+            for start in range(0, len(missing), 2048):
+                chunk = missing[start:start + 2048]
+                response = client.embeddings.create(
+                    model=deployment,
+                    input=[texts[i] for i in chunk]
+                )
+                for data in response.data:
+                    i = chunk[data.index]
+                    embeddings[i] = self._normalize(data.embedding)
+                    self._emb_cache.put(keys[i], embeddings[i])
+
+        return np.vstack(embeddings)
+
+    def retrieve_batch(self, queries: List[str], top_k: int = 3, similarity_threshold: float = 0.4,
+                       query_embeddings: Optional[List[np.ndarray]] = None) -> List[List[Hit]]:
+        """Retrieve relevant documents for several queries with one embeddings call and one FAISS search.
+        query_embeddings, if given, must be unit length (as returned by embed_query / embed_query_async)"""
+        cache_keys = [
+            (hashlib.blake2b(_canonicalize(query).encode()).digest(), top_k, similarity_threshold)
+            for query in queries
+        ]
+        batch_results = [self._result_cache.get(key) for key in cache_keys]
+        pending = [i for i, results in enumerate(batch_results) if results is None]
+        if not pending:
+            return batch_results
+
+        if query_embeddings is None:
+            query_matrix = self._get_embeddings_batch([queries[i] for i in pending])
+        else:
+            # One allocation for the whole batch; caller vectors may be cached, so they are never modified
+            query_matrix = np.empty((len(pending), self.index.d), dtype='float32')
+            for row, i in enumerate(pending):
+                query_matrix[row] = np.ravel(query_embeddings[i])
+        # Queries are normalized once when embedded, and index vectors once at build (or load) time,
+        # so inner-product distances are cosine similarities with no further normalization
+        query_matrix = np.ascontiguousarray(query_matrix, dtype='float32')
+        # The OpenMP thread count is per calling thread, so set it in the worker doing the search
+        faiss.omp_set_num_threads(FAISS_BATCH_THREADS if len(pending) >= BATCH_THREADS_MIN_QUERIES else FAISS_NUM_THREADS)
+        with self._search_lock:
+            distances, indices = self.index.search(query_matrix, top_k)
 
-    def retrieve(self, query: str, top_k: int = 3, similarity_threshold: float = 0.4) -> List[Dict[str, Any]]:
+        # Bounds and threshold checks for the whole batch at once; only survivors reach Python
+        keep = (indices >= 0) & (indices < self.knowledge_data.num_rows) & (distances >= similarity_threshold)
+        for row, i in enumerate(pending):
+            # Metadata is looked up by the caller, only for the hits it uses
+            results = list(map(Hit, indices[row][keep[row]].tolist(), distances[row][keep[row]].tolist()))
+            self._result_cache.put(cache_keys[i], results)
+            batch_results[i] = results
+
+        return batch_results
+
+    def retrieve(self, query: str, top_k: int = 3, similarity_threshold: float = 0.4,
+                 query_embedding: Optional[np.ndarray] = None) -> List[Hit]:
         """Retrieve relevant documents from vector store"""
-        query_embedding = self._get_embedding(query).reshape(1, -1)
-        distances, indices = self.index.search(query_embedding, top_k)
-
-        results = []
-        for i, idx in enumerate(indices[0]):
-            if 0 <= idx < len(self.knowledge_data):
-                # Compute cosine similarity
-                doc_embedding = self.index.reconstruct(int(idx)).reshape(1, -1)
-                sim = cosine_similarity(query_embedding, doc_embedding)[0][0]
-                if sim >= similarity_threshold:
-                    results.append({
-                        **self.knowledge_data[idx],
-                        "similarity": float(sim)
-                    })
-
-        return results
-
-    def as_tool(self, query: str) -> str:
+        query_embeddings = None if query_embedding is None else [query_embedding]
+        return self.retrieve_batch([query], top_k, similarity_threshold, query_embeddings)[0]
+
+    async def retrieve_async(self, query: str, top_k: int = 3, similarity_threshold: float = 0.4,
+                             query_embedding: Optional[np.ndarray] = None) -> List[Hit]:
+        """Async retrieve: batched embedding on the event loop, FAISS search in a worker thread"""
+        if query_embedding is None:
+            query_embedding = await self.embed_query_async(query)
+        return await asyncio.to_thread(self.retrieve, query, top_k, similarity_threshold, query_embedding)
+
+    async def as_tool_async(self, query: str, query_embedding: Optional[np.ndarray] = None) -> str:
+        """Async variant of as_tool for the agent's event loop"""
+        if query_embedding is None:
+            query_embedding = await self.embed_query_async(query)
+        # FAISS search releases the GIL; the event loop keeps serving other requests meanwhile
+        return await asyncio.to_thread(self.as_tool, query, query_embedding)
+
+    def as_tool(self, query: str, query_embedding: Optional[np.ndarray] = None) -> str:
         """Tool function for the agent to call"""
-        print(f"\n🔍 [RETRIEVER DEBUG] Query: '{query}'")
+        logger.debug("🔍 [RETRIEVER DEBUG] Query: %r", query)
         
-        docs = self.retrieve(query, top_k=5, similarity_threshold=0.4)
+        hits = self.retrieve(query, top_k=5, similarity_threshold=0.4, query_embedding=query_embedding)
         
-        if not docs:
-            print(f"❌ [RETRIEVER DEBUG] No relevant documents found")
+        if not hits:
+            logger.debug("❌ [RETRIEVER DEBUG] No relevant documents found")
             return "No relevant documents found in knowledge base."
         
-        # Show retrieved docs in terminal with book name and page number
-        print(f"✅ [RETRIEVER DEBUG] Found {len(docs)} relevant documents:")
-        for i, doc in enumerate(docs):
-            print(f"   📄 Document {i+1} (Similarity: {doc['similarity']:.3f})")
-            print(f"      Topic: {doc['ki_topic']}")
-            
-            # Show book name (source_file) if available
-            book_name = doc.get('source_file', 'Unknown Book')
-            print(f"      Book: {book_name}")
-            
-            # Show page number if available
-            if doc.get('page') and doc['page'] != '' and doc['page'] != 'None':
-                print(f"      Page: {doc['page']}")
-            
-            # Show chunk info if available
-            if doc.get('chunk_index') is not None and doc.get('total_chunks'):
-                print(f"      Chunk: {doc['chunk_index'] + 1}/{doc['total_chunks']}")
-            
-            # Show content preview
-            content_preview = doc['ki_text'][:150] + "..." if len(doc['ki_text']) > 150 else doc['ki_text']
-            print(f"      Content: {content_preview}")
-            print()
+        docs = [self._metadata_row(hit.idx) for hit in hits]
+        
+        # Show retrieved docs with book name and page number (skipped entirely unless debug logging is on)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("✅ [RETRIEVER DEBUG] Found %d relevant documents:", len(docs))
+            for i, (hit, doc) in enumerate(zip(hits, docs)):
+                logger.debug("   📄 Document %d (Similarity: %.3f)", i + 1, hit.similarity)
+                logger.debug("      Topic: %s", doc['ki_topic'])
+                
+                # Show book name (source_file) if available
+                logger.debug("      Book: %s", doc.get('source_file', 'Unknown Book'))
+                
+                # Show page number if available
+                page = doc.get('page') or ''
+                if page:
+                    logger.debug("      Page: %s", page)
+                
+                # Show chunk info if available
+                if doc.get('chunk_index') is not None and doc.get('total_chunks'):
+                    logger.debug("      Chunk: %d/%d", doc['chunk_index'] + 1, doc['total_chunks'])
+                
+                # Show content preview
+                content_preview = doc['ki_text'][:150] + "..." if len(doc['ki_text']) > 150 else doc['ki_text']
+                logger.debug("      Content: %s", content_preview)
         
         # Create context for the agent (include all metadata)
         context_parts = []
-        for i, doc in enumerate(docs):
-            context = f"Document {i+1} (Similarity: {doc['similarity']:.2f}):\n"
-            context += f"Topic: {doc['ki_topic']}\n"
+        for i, (hit, doc) in enumerate(zip(hits, docs)):
+            parts = [
+                f"Document {i+1} (Similarity: {hit.similarity:.2f}):\n",
+                f"Topic: {doc['ki_topic']}\n",
+            ]
             
             # Add book name to context for the agent
             if doc.get('source_file'):
-                context += f"Source: {doc['source_file']}\n"
+                parts.append(f"Source: {doc['source_file']}\n")
             
             # Add page number to context for the agent
-            if doc.get('page') and doc['page'] != '' and doc['page'] != 'None':
-                context += f"Page: {doc['page']}\n"
+            page = doc.get('page') or ''
+            if page:
+                parts.append(f"Page: {page}\n")
             
             # Add chunk info
             if doc.get('chunk_index') is not None and doc.get('total_chunks'):
-                context += f"Part: {doc['chunk_index'] + 1} of {doc['total_chunks']}\n"
+                parts.append(f"Part: {doc['chunk_index'] + 1} of {doc['total_chunks']}\n")
             
-            context += f"Content: {doc['ki_text']}"
-            context_parts.append(context)
+            parts.append(f"Content: {doc['ki_text']}")
+            context_parts.append("".join(parts))
         
         context = "\n\n".join(context_parts)
         
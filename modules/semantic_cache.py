@@ -0,0 +1,62 @@
+# semantic_cache.py
+
+import time
+import threading
+import faiss
+import numpy as np
+from typing import Optional
+
+class SemanticCache:
+    """In-process answer cache keyed by query embedding, matched by cosine similarity"""
+
+    def __init__(self, threshold: float = 0.94, ttl: float = 3600, max_size: int = 512):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+
+        # Index rows and entries stay aligned, oldest first
+        self._index = None  # created on first add, once the dimension is known
+        self._entries = []  # (answer, timestamp)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        """Unit-length row vector, so inner product equals cosine similarity"""
+        vec = np.array(embedding, dtype='float32').reshape(1, -1)
+        faiss.normalize_L2(vec)
+        return vec
+
+    def lookup(self, embedding) -> Optional[str]:
+        """Return a cached answer for a semantically equivalent query, if still fresh"""
+        with self._lock:
+            if not self._entries:
+                return None
+
+            distances, indices = self._index.search(self._normalize(embedding), 1)
+            idx = int(indices[0][0])
+            if idx < 0 or distances[0][0] < self.threshold:
+                return None
+
+            answer, timestamp = self._entries[idx]
+            if time.monotonic() - timestamp > self.ttl:
+                return None
+            return answer
+
+    def add(self, embedding, answer: str):
+        """Store an answer, evicting expired and oldest entries past max_size"""
+        vec = self._normalize(embedding)
+        with self._lock:
+            if self._index is None:
+                self._index = faiss.IndexFlatIP(vec.shape[1])
+            self._index.add(vec)
+            now = time.monotonic()
+            self._entries.append((answer, now))
+
+            # Entries are in insertion order, so expired ones form a prefix
+            expired = 0
+            while expired < len(self._entries) and now - self._entries[expired][1] > self.ttl:
+                expired += 1
+            evict = max(expired, len(self._entries) - self.max_size)
+            if evict > 0:
+                self._index.remove_ids(np.arange(evict, dtype='int64'))
+                del self._entries[:evict]
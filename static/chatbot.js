@@ -26,7 +26,7 @@ async function sendMessage(message = null) {
   showTyping();
 
   try {
-    const response = await fetch("/chat", {
+    const response = await fetch("/chat/stream", {
       method: "POST",
       headers: { "Content-Type": "application/json" },
       body: JSON.stringify({
@@ -35,16 +35,65 @@ async function sendMessage(message = null) {
         user_id: userId
       })
     });
-
-    const data = await response.json();
-    hideTyping();
-    appendMessage("Bot", data.response, false);
+    if (!response.ok || !response.body) throw new Error(`HTTP ${response.status}`);
+
+    // Read Server-Sent Events and render the answer as it streams in
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let answer = "";
+    let bubble = null;
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      const events = buffer.split("\n\n");
+      buffer = events.pop();
+      for (const rawEvent of events) {
+        const { event, data } = parseSSE(rawEvent);
+        if (event === "error") throw new Error(data.error);
+        if (data.token) {
+          answer += data.token;
+          if (!bubble) {
+            hideTyping();
+            bubble = appendMessage("Bot", answer, false);
+          } else {
+            renderBotMessage(bubble, answer);
+          }
+        }
+      }
+    }
+
+    if (!bubble) {
+      hideTyping();
+      appendMessage("Bot", answer || "❌ Error contacting the bot.", false);
+    }
   } catch (error) {
     hideTyping();
     appendMessage("Bot", "❌ Error contacting the bot.", false);
   }
 }
 
+function parseSSE(rawEvent) {
+  let event = "message";
+  const dataLines = [];
+  for (const line of rawEvent.split("\n")) {
+    if (line.startsWith("event:")) event = line.slice(6).trim();
+    else if (line.startsWith("data:")) dataLines.push(line.slice(5).trim());
+  }
+  return { event, data: dataLines.length ? JSON.parse(dataLines.join("\n")) : {} };
+}
+
+function renderBotMessage(bubble, message) {
+  let html = marked.parse(message);
+  html = html.replace(/<pre><code[^>]*>/g, '').replace(/<\/code><\/pre>/g, '');
+  bubble.innerHTML = html;
+  const chatBox = document.getElementById("chat-box");
+  chatBox.scrollTop = chatBox.scrollHeight;
+}
+
 function appendMessage(sender, message, isUser = false) {
   const chatBox = document.getElementById("chat-box");
   const msg = document.createElement("div");
@@ -56,18 +105,18 @@ function appendMessage(sender, message, isUser = false) {
   const bubble = document.createElement("div");
   bubble.className = "bubble";
 
+  msg.appendChild(avatar);
+  msg.appendChild(bubble);
+  chatBox.appendChild(msg);
+
   if (!isUser) {
-    let html = marked.parse(message);
-    html = html.replace(/<pre><code[^>]*>/g, '').replace(/<\/code><\/pre>/g, '');
-    bubble.innerHTML = html;
+    renderBotMessage(bubble, message);
   } else {
     bubble.textContent = message;
   }
 
-  msg.appendChild(avatar);
-  msg.appendChild(bubble);
-  chatBox.appendChild(msg);
   chatBox.scrollTop = chatBox.scrollHeight;
+  return bubble;
 }
 
 function showTyping() {